@@ -29,21 +29,32 @@ class LoadKeOps:
     :return: The Python function that corresponds to the loaded Keops kernel.
     """
 
+    # Modules already imported in the current process, indexed by (formula, aliases, dtype, lang, optional_flags)
+    # and stored as (dll_name, optional_flags, module) tuples. The torch Genred calls LoadKeOps at each
+    # forward and backward evaluation: this avoids hashing the formula and searching the python path every time.
+    loaded_modules = {}
+
     def __init__(self, formula, aliases, dtype, lang, optional_flags=[]):
         self.formula = formula
         self.aliases = aliases
         self.dtype = dtype
         self.lang = lang
-        self.optional_flags = optional_flags
+        self.optional_flags = list(optional_flags)
+
+        self.key = (formula, tuple(aliases), dtype, lang, tuple(optional_flags))
+        if (self.key in LoadKeOps.loaded_modules) and (pykeops.config.build_type != 'Debug'):
+            self.dll_name, self.optional_flags, _ = LoadKeOps.loaded_modules[self.key]
+            self.build_folder = set_build_folder(pykeops.config.bin_folder, self.dll_name)
+            return
 
         if TestChunkedTiles(formula):
             self.optional_flags += ['-DENABLECHUNK=1']
 
         # create the name from formula, aliases and dtype.
         self.dll_name = create_name(self.formula, self.aliases, self.dtype, self.lang, self.optional_flags)
+        self.build_folder = set_build_folder(pykeops.config.bin_folder, self.dll_name)
 
-        if (not module_exists(self.dll_name)) or (pykeops.config.build_type == 'Debug'):
-            self.build_folder = set_build_folder(pykeops.config.bin_folder, self.dll_name)
+        if (not module_exists(self.dll_name, pykeops.config.bin_folder)) or (pykeops.config.build_type == 'Debug'):
             self._safe_compile()
 
     @create_and_lock_build_folder()
@@ -52,4 +63,7 @@ class LoadKeOps:
                                 self.optional_flags, self.build_folder)
 
     def import_module(self):
-        return importlib.import_module(self.dll_name)
+        if self.key not in LoadKeOps.loaded_modules:
+            LoadKeOps.loaded_modules[self.key] = (self.dll_name, self.optional_flags,
+                                                  importlib.import_module(self.dll_name))
+        return LoadKeOps.loaded_modules[self.key][2]
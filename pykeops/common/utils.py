@@ -1,19 +1,37 @@
 import fcntl
 import functools
+import importlib.machinery
 import importlib.util
+import itertools
+import numbers
 import os
+import random
 import shutil
+import threading
 
 import pykeops.config
+from pykeops.common.parse_type import get_type
 
 c_type = dict(float16="half2", float32="float", float64="double")
 
 
-def module_exists(dllname):
+def module_exists(dllname, folder=None):
+    """
+    Check whether the python module dllname can be imported. If folder is given, we first look for
+    a compiled extension module in it, which is much cheaper than a search through the python path.
+    """
+    if folder is not None:
+        for suffix in importlib.machinery.EXTENSION_SUFFIXES:
+            if os.path.isfile(os.path.join(folder, dllname + suffix)):
+                return True
     spec = importlib.util.find_spec(dllname)
     return (spec is not None)
 
 
+# axis <-> cat lookup table (the mapping is an involution)
+_axis_cat = (1, 0)
+
+
 def axis2cat(axis):
     """
     Axis is the dimension to sum (the pythonic way). Cat is the dimension that
@@ -21,10 +39,9 @@ def axis2cat(axis):
     :param axis: 0 or 1
     :return: cat: 1 or 0
     """
-    if axis in [0, 1]:
-        return (axis + 1) % 2
-    else:
+    if not isinstance(axis, numbers.Integral) or (axis != 0 and axis != 1):
         raise ValueError("Axis should be 0 or 1.")
+    return _axis_cat[axis]
 
 
 def cat2axis(cat):
@@ -34,10 +51,9 @@ def cat2axis(cat):
     :param cat: 0 or 1
     :return: axis: 1 or 0
     """
-    if cat in [0, 1]:
-        return (cat + 1) % 2
-    else:
+    if not isinstance(cat, numbers.Integral) or (cat != 0 and cat != 1):
         raise ValueError("Category should be Vi or Vj.")
+    return _axis_cat[cat]
 
 
 class FileLock:
@@ -53,6 +69,18 @@ class FileLock:
         fcntl.flock(self.fd, fcntl.LOCK_UN)
 
 
+# In-process locks, one per build folder. Compilations themselves are already serialized by the
+# file lock (flock also conflicts between two open() of the same file in one process): these locks
+# mainly keep the makedirs / rmtree of a build folder from racing between threads.
+build_folder_locks = {}
+build_folder_locks_guard = threading.Lock()
+
+
+def get_build_folder_lock(bf):
+    with build_folder_locks_guard:
+        return build_folder_locks.setdefault(bf, threading.Lock())
+
+
 def create_and_lock_build_folder():
     """
     This function is used to create and lock the building dir (see cmake) too avoid two concurrency
@@ -64,17 +92,25 @@ def create_and_lock_build_folder():
         def wrapper_filelock(*args, **kwargs):
             # get build folder name
             bf = args[0].build_folder
-            # create build folder
-            os.makedirs(bf, exist_ok=True)
-
-            # create a file lock to prevent multiple compilations at the same time
-            with open(os.path.join(bf, 'pykeops_build2.lock'), 'w') as f:
-                with FileLock(f):
-                    func_res = func(*args, **kwargs)
 
-            # clean
-            if (module_exists(args[0].dll_name)) and (pykeops.config.build_type == 'Release'):
-                shutil.rmtree(bf)
+            with get_build_folder_lock(bf):
+                # create build folder
+                os.makedirs(bf, exist_ok=True)
+
+                # create a file lock to prevent multiple compilations at the same time
+                with open(os.path.join(bf, 'pykeops_build2.lock'), 'w') as f:
+                    with FileLock(f):
+                        # the module may have been compiled by another thread or process while we were waiting
+                        importlib.invalidate_caches()
+                        if module_exists(args[0].dll_name, pykeops.config.bin_folder) and (pykeops.config.build_type == 'Release'):
+                            func_res = None
+                        else:
+                            func_res = func(*args, **kwargs)
+
+                        # clean, while still holding the lock: the build folder is specific to this
+                        # module, and nobody else may be using it at this point
+                        if (module_exists(args[0].dll_name, pykeops.config.bin_folder)) and (pykeops.config.build_type == 'Release'):
+                            shutil.rmtree(bf, ignore_errors=True)
 
             return func_res
 
@@ -102,13 +138,45 @@ def get_tools(lang):
     return tools
 
 
-def WarmUpGpu(lang):
+def WarmUpGpu(lang, formulas=None, dtype='float32'):
+    """
+    Compile and run some KeOps reductions on dummy data, so that the first "real" calls
+    do not pay the compilation and Gpu initialization costs (useful for accurate timings).
+
+    :param lang: a string with the langage ('torch'/'pytorch' or 'numpy')
+    :param formulas: a list of (formula, aliases) pairs, reduced with a 'Sum' along axis 1.
+                     If None, a simple 'SqDist(x,y)' formula is used.
+    :param dtype: a string with the dtype of the dummy data ('float16', 'float32' or 'float64')
+    :return: None
+    """
     tools = get_tools(lang)
-    # dummy first calls for accurate timing in case of GPU use
-    my_routine = tools.Genred("SqDist(x,y)", ["x = Vi(1)",  "y = Vj(1)"], reduction_op='Sum', axis=1, dtype=tools.dtype)
-    dum = tools.rand(10, 1)
-    my_routine(dum, dum)
-    my_routine(dum, dum)
+
+    if formulas is None:
+        formulas = [("SqDist(x,y)", ["x = Vi(1)", "y = Vj(1)"])]
+
+    # torch dummy data lives on the Gpu, as real data usually does (float16 is only supported there)
+    device = 'cuda' if (lang != "numpy" and pykeops.config.gpu_available) else 'cpu'
+
+    for (formula, aliases) in formulas:
+        my_routine = tools.Genred(formula, aliases, reduction_op='Sum', axis=1, dtype=dtype)
+
+        # dummy data: 10 lines for Vi and Vj variables, a vector for parameters
+        args = []
+        for alias in aliases:
+            _, cat, dim, _ = get_type(alias)
+            if cat == 2:
+                dum = [random.random() for _ in range(dim)]
+            else:
+                dum = [[random.random() for _ in range(dim)] for _ in range(10)]
+            args.append(tools.array(dum, dtype=dtype, device=device))
+
+        # two dummy calls, with the gradient (i.e. its formulas) when it is available
+        for _ in range(2):
+            if lang == "numpy":
+                my_routine(*args)
+            else:
+                args = [arg.detach().requires_grad_(True) for arg in args]
+                my_routine(*args).sum().backward()
 
 
 def clean_pykeops(path="", lang=""):
@@ -125,24 +193,21 @@ def clean_pykeops(path="", lang=""):
             print(os.path.join(path, f) + " has been removed.")
 
 
-def max_tuple(a, b):
-    return tuple( max(a_i, b_i) for (a_i, b_i) in zip(a, b) )
-
-
+@functools.lru_cache(maxsize=128)
 def check_broadcasting(dims_1, dims_2):
     r"""
     Checks that the shapes **dims_1** and **dims_2** are compatible with each other.
+    The result is cached, since LazyTensors are usually combined with the same batch dimensions.
     """
     if dims_1 is None:
         return dims_2
     if dims_2 is None:
         return dims_1
-    
-    padded_dims_1 = (1,) * (len(dims_2) - len(dims_1)) + dims_1
-    padded_dims_2 = (1,) * (len(dims_1) - len(dims_2)) + dims_2
-    
-    for (dim_1, dim_2) in zip(padded_dims_1, padded_dims_2):
+
+    out = []
+    for (dim_1, dim_2) in itertools.zip_longest(reversed(dims_1), reversed(dims_2), fillvalue=1):
         if dim_1 != 1 and dim_2 != 1 and dim_1 != dim_2:
             raise ValueError("Incompatible batch dimensions: {} and {}.".format(dims_1, dims_2))
-    
-    return max_tuple(padded_dims_1, padded_dims_2)
\ No newline at end of file
+        out.append(dim_1 if dim_1 >= dim_2 else dim_2)
+
+    return tuple(reversed(out))
@@ -264,6 +264,54 @@ class NumpyUnitTestCase(unittest.TestCase):
         cnp = np.argsort(np.sum((self.x[:,np.newaxis,:] - self.y[np.newaxis,:,:]) ** 2, axis=2), axis=1)[:,:3]
         self.assertTrue(np.allclose(c.ravel(),cnp.ravel()))
     
+    ############################################################
+    def test_WarmUpGpu(self):
+    ############################################################
+        from pykeops.common.utils import WarmUpGpu
+        formulas = [('Exp(-oos2*SqDist(x,y))*b', ['x = Vi(3)', 'y = Vj(3)', 'b = Vj(2)', 'oos2 = Pm(1)'])]
+        for t in self.type_to_test:
+            WarmUpGpu('numpy', formulas=formulas, dtype=t)
+
+        # default formula
+        WarmUpGpu('numpy')
+
+    ############################################################
+    def test_check_broadcasting(self):
+    ############################################################
+        from pykeops.common.utils import check_broadcasting
+
+        self.assertEqual(check_broadcasting((1, 4), (5, 1, 1)), (5, 1, 4))
+        self.assertEqual(check_broadcasting((5, 1, 1), (1, 4)), (5, 1, 4))
+        self.assertEqual(check_broadcasting(None, (2, 3)), (2, 3))
+        self.assertEqual(check_broadcasting((2, 3), None), (2, 3))
+        self.assertEqual(check_broadcasting(None, None), None)
+        with self.assertRaises(ValueError):
+            check_broadcasting((2, 3), (4, 3))
+
+        # results are cached
+        hits = check_broadcasting.cache_info().hits
+        self.assertEqual(check_broadcasting((1, 4), (5, 1, 1)), (5, 1, 4))
+        self.assertEqual(check_broadcasting.cache_info().hits, hits + 1)
+
+    ############################################################
+    def test_module_exists(self):
+    ############################################################
+        import importlib.machinery
+        import tempfile
+        from pykeops.common.utils import module_exists
+
+        with tempfile.TemporaryDirectory() as folder:
+            name = 'libKeOpsDummyModuleForTests'
+            self.assertFalse(module_exists(name, folder))
+
+            # a compiled module in the folder is found without the import machinery
+            open(os.path.join(folder, name + importlib.machinery.EXTENSION_SUFFIXES[0]), 'w').close()
+            self.assertTrue(module_exists(name, folder))
+
+            # otherwise, we fall back to importlib.util.find_spec
+            self.assertTrue(module_exists('unittest', folder))
+            self.assertFalse(module_exists(name + 'Missing', folder))
+
     ############################################################
     def test_LazyTensor_sum(self):
     ############################################################
@@ -399,6 +399,25 @@ class PytorchUnitTestCase(unittest.TestCase):
 
         self.assertTrue(type(kernel_instance), type(deserialized_kernel))
     
+    ############################################################
+    def test_WarmUpGpu(self):
+        ############################################################
+        from pykeops.common.utils import WarmUpGpu
+        formulas = [('Exp(-oos2*SqDist(x,y))*b', ['x = Vi(3)', 'y = Vj(3)', 'b = Vj(2)', 'oos2 = Pm(1)'])]
+        for t in ['float32', 'float64']:
+            WarmUpGpu('torch', formulas=formulas, dtype=t)
+
+        # default formula
+        WarmUpGpu('torch')
+
+    ############################################################
+    @unittest.skipIf(not pykeops.config.gpu_available, 'No GPU detected. Skip tests.')
+    def test_WarmUpGpu_float16(self):
+        ############################################################
+        from pykeops.common.utils import WarmUpGpu
+        formulas = [('Exp(-oos2*SqDist(x,y))*b', ['x = Vi(3)', 'y = Vj(3)', 'b = Vj(2)', 'oos2 = Pm(1)'])]
+        WarmUpGpu('torch', formulas=formulas, dtype='float16')
+
     ############################################################
     def test_LazyTensor_sum(self):
         ############################################################
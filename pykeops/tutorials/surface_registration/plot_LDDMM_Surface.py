@@ -19,6 +19,7 @@ import os
 import time
 
 import numpy as np
+import torch.utils.checkpoint
 from torch.autograd import grad
 
 import plotly
@@ -36,6 +37,10 @@ torchdtype = torch.float32
 KeOpsdeviceId = torchdeviceId.index  # id of Gpu device (in case Gpu is  used)
 KeOpsdtype = torchdtype.__str__().split('.')[1]  # 'float32'
 
+# On the Gpu, torchdtype may be set to torch.float16 to halve the memory traffic
+# of the kernel reductions: the sums are then accumulated in float32.
+KeOpsdtype_acc = 'float32' if KeOpsdtype == 'float16' else 'auto'
+
 
 ####################################################################
 # Import data file, one of :
@@ -62,7 +67,7 @@ def GaussKernel(sigma):
     gamma = 1 / (sigma * sigma)
     D2 = x.sqdist(y)
     K = (-D2*gamma).exp()
-    return (K*b).sum_reduction(axis=1)
+    return (K*b).sum_reduction(axis=1, dtype_acc=KeOpsdtype_acc)
 
 ###################################################################
 # Define "Gaussian-CauchyBinet" kernel :math:`(K(x,y,u,v)b)_i = \sum_j \exp(-\gamma\|x_i-y_j\|^2) \langle u_i,v_j\rangle^2 b_j`
@@ -72,20 +77,46 @@ def GaussLinKernel(sigma):
     gamma = 1 / (sigma * sigma)
     D2 = x.sqdist(y)
     K = (-D2*gamma).exp() * (u*v).sum()**2
-    return (K*b).sum_reduction(axis=1)
+    return (K*b).sum_reduction(axis=1, dtype_acc=KeOpsdtype_acc)
+
+###################################################################
+# Define the gradient with respect to :math:`q` of the Hamiltonian :math:`H(p,q)=\frac{1}{2}\langle p,K(q,q)p\rangle`
+# associated to the Gaussian kernel: :math:`(\partial_q H)_i = -2\gamma \sum_j \exp(-\gamma\|q_i-q_j\|^2) \langle p_i,p_j\rangle (q_i-q_j)`.
+# Computing it with a single reduction avoids the double differentiation of the kernel in the shooting.
+
+def GaussKernelHamiltonianGrad(sigma):
+    qi, qj, pi, pj = Vi(0,3), Vj(1,3), Vi(2,3), Vj(3,3)
+    gamma = 1 / (sigma * sigma)
+    D2 = qi.sqdist(qj)
+    K = (-D2*gamma).exp() * (pi*pj).sum()
+    return (K*(qi-qj)*(-2*gamma)).sum_reduction(axis=1, dtype_acc=KeOpsdtype_acc)
 
 ####################################################################
-# Custom ODE solver, for ODE systems which are defined on tuples
-def RalstonIntegrator():
+# Custom ODE solver, for ODE systems which are defined on tuples.
+# With ``checkpoint=True``, only the states are kept for the backward pass and
+# each step is recomputed during the backward: this reduces the memory footprint,
+# at the cost of one extra forward pass. The ODE system should not rely on
+# autograd itself in this case (e.g. use an explicit Hamiltonian gradient).
+def RalstonIntegrator(checkpoint=False):
     def f(ODESystem, x0, nt, deltat=1.0):
         x = tuple(map(lambda x: x.clone(), x0))
         dt = deltat / nt
-        l = [x]
-        for i in range(nt):
+
+        def step(*x):
             xdot = ODESystem(*x)
-            xi = tuple(map(lambda x, xdot: x + (2 * dt / 3) * xdot, x, xdot))
+            xi = tuple(map(lambda x, xdot: torch.add(x, xdot, alpha=2 * dt / 3), x, xdot))
             xdoti = ODESystem(*xi)
-            x = tuple(map(lambda x, xdot, xdoti: x + (.25 * dt) * (xdot + 3 * xdoti), x, xdot, xdoti))
+            # a single new tensor per variable: the in-place update of a fresh
+            # output is compatible with autograd
+            return tuple(map(lambda x, xdot, xdoti: torch.add(x, xdot, alpha=.25 * dt).add_(xdoti, alpha=.75 * dt),
+                             x, xdot, xdoti))
+
+        l = [x]
+        for i in range(nt):
+            if checkpoint:
+                x = tuple(torch.utils.checkpoint.checkpoint(step, *x))
+            else:
+                x = step(*x)
             l.append(x)
         return l
     
@@ -104,14 +135,18 @@ def RalstonIntegrator():
 
 def Hamiltonian(K):
     def H(p, q):
-        return .5 * (p * K(q, q, p)).sum()
+        return .5 * torch.dot(p.flatten(), K(q, q, p).flatten())
     return H
 
 
-def HamiltonianSystem(K):
+def HamiltonianSystem(K, HGrad=None):
     H = Hamiltonian(K)
     def HS(p, q):
-        Gp, Gq = grad(H(p, q), (p, q), create_graph=True)
+        if HGrad is None:
+            Gp, Gq = grad(H(p, q), (p, q), create_graph=True)
+        else:
+            # explicit gradients (K is symmetric)
+            Gp, Gq = K(q, q, p), HGrad(q, q, p, p)
         return -Gq, Gp
     return HS
 
@@ -119,20 +154,20 @@ def HamiltonianSystem(K):
 #####################################################################
 # Shooting approach
 
-def Shooting(p0, q0, K, nt=10, Integrator=RalstonIntegrator()):
-    return Integrator(HamiltonianSystem(K), (p0, q0), nt)
+def Shooting(p0, q0, K, nt=10, Integrator=RalstonIntegrator(), HGrad=None):
+    return Integrator(HamiltonianSystem(K, HGrad), (p0, q0), nt)
 
 
-def Flow(x0, p0, q0, K, deltat=1.0, Integrator=RalstonIntegrator()):
-    HS = HamiltonianSystem(K)
+def Flow(x0, p0, q0, K, deltat=1.0, Integrator=RalstonIntegrator(), HGrad=None):
+    HS = HamiltonianSystem(K, HGrad)
     def FlowEq(x, p, q):
         return (K(x, q, p),) + HS(p, q)
     return Integrator(FlowEq, (x0, p0, q0), deltat)[0]
 
 
-def LDDMMloss(K, dataloss, gamma=0):
+def LDDMMloss(K, dataloss, gamma=0, HGrad=None):
     def loss(p0, q0):
-        p,q = Shooting(p0, q0, K)[-1]
+        p,q = Shooting(p0, q0, K, HGrad=HGrad)[-1]
         return gamma * Hamiltonian(K)(p0, q0) + dataloss(q)
     return loss
 
@@ -148,10 +183,12 @@ def LDDMMloss(K, dataloss, gamma=0):
 # K kernel
 def lossVarifoldSurf(FS, VT, FT, K):
     def get_center_length_normal(F, V):
-        V0, V1, V2 = V.index_select(0, F[:, 0]), V.index_select(0, F[:, 1]), V.index_select(0, F[:, 2])
-        centers, normals =  (V0 + V1 + V2) / 3, .5 * torch.cross(V1 - V0, V2 - V0)
-        length = (normals ** 2).sum(dim=1)[:, None].sqrt()
-        return centers, length, normals/ length
+        # a single gather of the (nfaces, 3, 3) vertices coordinates
+        V012 = V.index_select(0, F.reshape(-1)).view(-1, 3, 3)
+        V0, V1, V2 = V012.unbind(dim=1)
+        centers, normals = V012.mean(dim=1), .5 * torch.cross(V1 - V0, V2 - V0, dim=1)
+        length = normals.norm(dim=1, keepdim=True)
+        return centers, length, normals / length
     
     CT, LT, NTn = get_center_length_normal(FT, VT)
     cst = (LT * K(CT, CT, NTn, NTn, LT)).sum()
@@ -169,11 +206,16 @@ def lossVarifoldSurf(FS, VT, FT, K):
 ####################################################################
 # Load the dataset and plot it
 
+def to_device(x, dtype):
+    # copies from pinned host memory are asynchronous
+    x = x.detach().pin_memory() if use_cuda else x.clone().detach()
+    return x.to(dtype=dtype, device=torchdeviceId, non_blocking=True)
+
 VS, FS, VT, FT = torch.load(datafile)
-q0 = VS.clone().detach().to(dtype=torchdtype, device=torchdeviceId).requires_grad_(True)
-VT = VT.clone().detach().to(dtype=torchdtype, device=torchdeviceId)
-FS = FS.clone().detach().to(dtype=torch.long, device=torchdeviceId)
-FT = FT.clone().detach().to(dtype=torch.long, device=torchdeviceId)
+q0 = to_device(VS, torchdtype).requires_grad_(True)
+VT = to_device(VT, torchdtype)
+FS = to_device(FS, torch.long)
+FT = to_device(FT, torch.long)
 sigma = torch.tensor([20], dtype=torchdtype, device=torchdeviceId)
 
 x, y, z = q0[:,0].detach().cpu().numpy(), q0[:,1].detach().cpu().numpy(), q0[:,2].detach().cpu().numpy()
@@ -203,7 +245,8 @@ fig.write_html(save_folder + 'data.html', auto_open=False)
 
 dataloss = lossVarifoldSurf(FS, VT, FT, GaussLinKernel(sigma=sigma))
 Kv = GaussKernel(sigma=sigma)
-loss = LDDMMloss(Kv, dataloss)
+HGradv = GaussKernelHamiltonianGrad(sigma=sigma)
+loss = LDDMMloss(Kv, dataloss, HGrad=HGradv)
 
 ######################################################################
 # Perform optimization
@@ -212,8 +255,6 @@ loss = LDDMMloss(Kv, dataloss)
 p0 = torch.zeros(q0.shape, dtype=torchdtype, device=torchdeviceId, requires_grad=True)
 
 optimizer = torch.optim.LBFGS([p0], max_eval=10, max_iter=10)
-print('performing optimization...')
-start = time.time()
 
 def closure():
     optimizer.zero_grad()
@@ -222,10 +263,22 @@ def closure():
     L.backward()
     return L
 
+# dummy first call, out of the timed loop: it compiles the KeOps formulas
+# (and their gradients) that are actually used, and initializes the Gpu.
+print('warming up...')
+closure()
+if use_cuda:
+    torch.cuda.synchronize()
+
+print('performing optimization...')
+start = time.time()
+
 for i in range(10):
     print('it ', i, ': ', end='')
     optimizer.step(closure)
-    
+
+if use_cuda:
+    torch.cuda.synchronize()
 print('Optimization (L-BFGS) time: ', round(time.time() - start, 2), ' seconds')
 
 ####################################################################
@@ -233,7 +286,7 @@ print('Optimization (L-BFGS) time: ', round(time.time() - start, 2), ' seconds')
 # --------------
 # The animated version of the deformation:
 nt = 15
-listpq = Shooting(p0, q0, Kv, nt=nt)
+listpq = Shooting(p0, q0, Kv, nt=nt, HGrad=HGradv)
 
 ############################################################################
 # .. raw:: html